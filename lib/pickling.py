@@ -1,22 +1,31 @@
 import bz2
 import sys
 import os
-try:
-  import cPickle as pickle
-except:
-  import pickle
+import pickle
+import zstandard as zstd
+
+BZ2_MAGIC = b"BZh"
+PICKLE_COMPRESSION_LEVEL = 3
 
 # Pickle a file and then compress it into a file with extension
+# The pickle is written to a temporary file and renamed over the old one so it is never left half written
 def compress_pickle(filename, data):
     sys.stderr.write(f"saving pickle {filename}...\n")
-    os.system(f"cp {filename} {filename}.bkp")
-    with bz2.BZ2File(filename, "w") as f:
-        pickle.dump(data, f)
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "wb") as f:
+        with zstd.ZstdCompressor(level=PICKLE_COMPRESSION_LEVEL, threads=-1).stream_writer(f) as writer:
+            pickle.dump(data, writer, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filename, filename)
 
 
-# Load any compressed pickle file
+# Load any compressed pickle file, bz2 files written by older versions are still supported
 def decompress_pickle(filename):
     sys.stderr.write(f"loading pickle {filename}...\n")
-    data = bz2.BZ2File(filename, "rb")
-    data = pickle.load(data)
-    return data
+    with open(filename, "rb") as f:
+        if f.read(len(BZ2_MAGIC)) == BZ2_MAGIC:
+            f.seek(0)
+            with bz2.BZ2File(f, "rb") as reader:
+                return pickle.load(reader)
+        f.seek(0)
+        with zstd.ZstdDecompressor().stream_reader(f) as reader:
+            return pickle.load(reader)
@@ -0,0 +1,104 @@
+from fractions import Fraction
+from itertools import islice
+from operator import mul
+
+# Sage-free helpers on the terms of a sequence, run for every sequence in the main loop
+
+
+def parse_terms(sdata, count=None):
+    """
+    Parses the comma separated terms of a sequence.
+
+    Args:
+        sdata (str): Comma separated terms.
+        count (int): Parse only the first count terms, the rest of the string is not split.
+
+    Returns:
+        list: List of integers.
+    """
+    if count is None:
+        return list(map(int, sdata.split(",")))
+    return list(map(int, islice(sdata.split(",", count), count)))
+
+
+def recurrence_holds(coefficients, data, start):
+    """
+    Checks that the linear recurrence a(n) = c_1*a(n-1) + ... + c_d*a(n-d) reproduces the data.
+
+    Args:
+        coefficients (list): Recurrence coefficients c_1..c_d.
+        data (list): List of integers representing the sequence.
+        start (int): First index to check.
+
+    Returns:
+        bool: True if every term from start onward satisfies the recurrence.
+    """
+    order = len(coefficients)
+    # Reversed so that it lines up with the window data[n - order:n]
+    reversed_coefficients = coefficients[::-1]
+    for n in range(max(start, order), len(data)):
+        if data[n] != sum(map(mul, reversed_coefficients, data[n - order:n])):
+            return False
+    return True
+
+
+def linear_complexity(terms, bound=None):
+    """
+    Computes the order of the shortest linear recurrence generating the terms,
+    with the Berlekamp-Massey algorithm over the rationals.
+
+    Args:
+        terms (tuple): Sequence terms.
+        bound (int): Stop as soon as the order exceeds bound.
+
+    Returns:
+        int: The order, or the first order above bound.
+    """
+    C, B = [Fraction(1)], [Fraction(1)]
+    L, m, b = 0, 1, Fraction(1)
+    for n, term in enumerate(terms):
+        d = term + sum(C[i] * terms[n - i] for i in range(1, L + 1))
+        if d == 0:
+            m += 1
+            continue
+        T = C[:]
+        C += [Fraction(0)] * (len(B) + m - len(C))
+        coef = d / b
+        for i, b_i in enumerate(B):
+            C[i + m] -= coef * b_i
+        if 2 * L <= n:
+            L, B, b, m = n + 1 - L, T, d, 1
+            if bound is not None and L > bound:
+                return L
+        else:
+            m += 1
+    return L
+
+
+def plausibly_cfinite(terms):
+    """
+    Tells whether the terms can evidence a C-finite recurrence: the shortest one
+    must be determined by fewer terms than given, 2 * order < len(terms).
+    Otherwise any guess would merely interpolate them.
+
+    Args:
+        terms (tuple): Sequence terms.
+
+    Returns:
+        bool: False if no recurrence can be confirmed from the terms.
+    """
+    bound = (len(terms) - 1) // 2
+    return linear_complexity(terms, bound) <= bound
+
+
+def list_compare(A,B):
+    """
+    Compare elementwise two lists.
+    Args:
+        Lists: A,B.
+    Returns:
+        Boolean
+    Comment:
+        List equality compares in C and stops at the first difference, no Python loop is involved.
+    """
+    return A == B[:len(A)]
@@ -4,52 +4,169 @@ import re
 import os
 import sys
 import time
-import json
 import requests
 import sqlite3
-import lzo
+import queue
+import threading
 import gzip
+import mmap
+import hashlib
+import zstandard as zstd
+import random
 import argparse
+import multiprocessing
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-from functools import cache
-from sage.all import CFiniteSequences, QQ, ZZ, sage_eval, var
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from functools import lru_cache
+from itertools import combinations, islice
+from sage.all import AlarmInterrupt, CFiniteSequences, QQ, RealField, SR, ZZ, alarm, cancel_alarm, sage_eval, var
 from sage.all_cmdline import fast_callable
 from lib.pickling import *
 from lib.blacklist import *
+from lib.terms import *
+
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    import json
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+try:
+    import lzo
+except ImportError:
+    lzo = None
+
+try:
+    import re2
+except ImportError:
+    re2 = None
 
 # Constants
 ALGORITHMS = ['sage', 'pari']
 OEIS_DATA_DIR = 'oeis_data'
 OEIS_DB_PATH = os.path.join(OEIS_DATA_DIR, 'oeis.db')
 XREF_PKL_FILE = os.path.join(OEIS_DATA_DIR, 'xref.pkl')
-SEQUENCE_MODE = "lzo"
+# Storage mode of newly cached sequences: "zst", or "raw" to keep them uncompressed for testing
+SEQUENCE_MODE = "zst"
+READABLE_SEQUENCE_MODES = ['zst', 'raw'] + (['lzo', 'lzogzip'] if lzo is not None else [])
+LEGACY_SEQUENCE_MODES = [mode for mode in READABLE_SEQUENCE_MODES if mode != SEQUENCE_MODE]
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+GZIP_MAGIC = b'\x1f\x8b'
+MMAP_THRESHOLD = 1 << 20
+ZSTD_LEVEL = 3
+ZDICT_PATH = os.path.join(OEIS_DATA_DIR, 'zdict')
+ZDICT_SIZE = 100_000
+ZDICT_SAMPLES = 10_000
+OEIS_SEARCH_URL = "https://oeis.org/search?fmt=json&q=id:{}"
+HTTP_TIMEOUT = (3, 10)
+HTTP_USER_AGENT = "oeis_closed_form_miner (https://github.com/daedalus/oeis_closed_form_miner)"
+FETCH_WORKERS = 16
+FETCH_DEPTH = 64
+MAX_REQUESTS_PER_SECOND = 20
+UPDATE_BATCH_SIZE = 500
+WRITE_QUEUE_SIZE = 1024
+ID_PAGE_SIZE = 1000
+SIMPLIFY_WORKERS = 4
+SIMPLIFY_TIMEOUT = 5
+SIMPLIFY_BUDGET = 4
+VERIFY_GUARD_BITS = 64
+GUESS_WORKERS = os.cpu_count()
+GUESS_BATCH_SIZE = 64
+PREFLIGHT_TERMS = 5
+# Part of the guess_cache key, bump it whenever check_sequence can give a different result
+GUESS_VERSION = 2
+UNPROCESSED_CONDITION = "name IS NULL"
+REPROCESS_CONDITION = "(closed_form IS NULL OR closed_form = '') AND name IS NOT NULL"
+UNCHECKED_CONDITION = "closed_form IS NOT NULL AND check_cf IS NULL"
+PARSED_CONDITION = "parsed_formulas IS NOT NULL"
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA cache_size=-200000;",
+    "PRAGMA mmap_size=268435456;",
+    "PRAGMA wal_autocheckpoint=10000;",
+]
+
+# HTTP session shared by every request to reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": HTTP_USER_AGENT, "Accept-Encoding": "gzip"})
+SESSION.mount("https://", HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS * 2,
+                                      max_retries=Retry(total=3, backoff_factor=0.3,
+                                                        status_forcelist=[429, 500, 502, 503, 504])))
+
+# In-memory index of the sequence cache, see cached_sequence_index()
+CACHE_INDEX = None
+
+# Worker processes running Maxima simplifications, see simplify_expression().
+# The pool is (re)created while the download and writer threads run, so its workers come from
+# a forkserver with Sage preloaded instead of forking the threaded miner.
+SIMPLIFY_POOL = None
+SIMPLIFY_CONTEXT = multiprocessing.get_context('forkserver')
+SIMPLIFY_CONTEXT.set_forkserver_preload(['sage.all'])
+
+# Request spacing shared by the download threads, see throttle()
+THROTTLE_LOCK = threading.Lock()
+NEXT_REQUEST_TIME = 0.0
+
+# Zstandard contexts for the sequence cache, built around the trained dictionary when there is one
+ZCTX_C = ZCTX_D = None
+ZCTX_D_PLAIN = zstd.ZstdDecompressor()
+
+# C-finite sequence rings tried in order by guess_cfinite()
+CFINITE_RINGS = [(ZZ, CFiniteSequences(ZZ)), (QQ, CFiniteSequences(QQ))]
+
+# Symbolic variables of closed forms, var() is costly enough not to call it per formula
+X = var('x')
+N = var('n')
+
+# Namespaces handed to sage_eval, built once instead of per formula
+EXPRESSION_LOCALS = {'n': X, 'x': X}
+SIMPLIFY_LOCALS = {'n': N, 'x': X}
+CLOSED_FORM_LOCALS = {'n': N}
 
 # Regular expressions
-OEIS_FORMULA_REGEX_1 = '^a\(n\)\s\=\s(.*)\.\s\-\s\_(.*)\_\,(.*)$'
-OEIS_FORMULA_REGEX_2 = '^a\(n\)\s\=\s(.*)\.$'
-OEIS_FORMULA_REGEX_3 = '^a\(n\)\s\=\s(.*)\.|(\s\-\s\_(.*)\_\,(.*))$'
-OEIS_FORMULA_REGEX_4 = '^a\(n\)\s\=\s(.*)\.$|a\(n\)\s\=\s(.*)\.(\s\-\s\_(.*)\_\,(.*))$'
 OEIS_XREF_REGEX = 'A[0-9]{6}'
 
+# Anchored by fullmatch, with non-greedy groups so a signed formula can not backtrack over every split
+OEIS_FORMULA_REGEX_5 = r'a\(n\)\s=\s(.*)\.'
+OEIS_FORMULA_REGEX_6 = r'a\(n\)\s=\s(.*?)\.\s-\s_(.*?)_,(.*)'
+
+# Compiled once at import, the patterns are matched against every formula of every sequence.
+# RE2 runs them as a DFA without backtracking when google-re2 is installed, its \s is ASCII only
+# like the re.ASCII fallback, a formula never needs more.
+def compile_pattern(pattern):
+    return re2.compile(pattern) if re2 is not None else re.compile(pattern, re.ASCII)
+
+OEIS_NAME_PATTERNS = (compile_pattern(OEIS_FORMULA_REGEX_5),)
+OEIS_FORMULA_PATTERNS = (compile_pattern(OEIS_FORMULA_REGEX_5), compile_pattern(OEIS_FORMULA_REGEX_6))
+OEIS_XREF_RE = compile_pattern(OEIS_XREF_REGEX)
+WHITESPACE_RE = re.compile(r'\s+')
+
 # Functions
-def regex_match_one(regex, expression):
+def regex_match_one(patterns, expression):
     """
-    Matches an expression (formula in the OEIS format) to a regex.
+    Matches an expression (formula in the OEIS format) to the first pattern that fully matches it.
 
     Args:
-        regex (str): Regular expression pattern.
+        patterns (tuple): Compiled regular expression patterns, the formula is their first group.
         expression (str): Expression to match.
 
     Returns:
         str or None: A string representation of a formula.
     """
-    try:
-        if (match_groups := re.match(regex, expression).groups()):
-            return match_groups[1] if match_groups[0] is None else match_groups[0]
-    except Exception:
-        return None
+    for pattern in patterns:
+        if (match := pattern.fullmatch(expression)) is not None:
+            return match.group(1)
+    return None
 
 
+@lru_cache(maxsize=200_000)
 def string_to_expression(s):
     """
     Evaluate a string to a SageMath expression.
@@ -61,45 +178,116 @@ def string_to_expression(s):
         Expression: A SageMath expression or None.
     """
     try:
-        return sage_eval(s, locals={'n': var('x'),'x':var('x')})
+        return sage_eval(s, locals=EXPRESSION_LOCALS)
     except Exception:
         return
 
 
-def simplify_expression(cf):
+def simplify_worker(s, budget=SIMPLIFY_BUDGET):
+    """
+    Parses and simplifies an expression, runs in a process of the simplification pool.
+    Maxima is interrupted after budget seconds, so the worker gives up before the pool
+    has to be killed.
+
+    Args:
+        s (str): Expression.
+        budget (float): Seconds allowed for the simplification.
+
+    Returns:
+        str or None: Simplified expression.
+    """
+    try:
+        alarm(budget)
+        return str(sage_eval(s, locals=SIMPLIFY_LOCALS).full_simplify())
+    except (Exception, AlarmInterrupt):
+        return
+    finally:
+        cancel_alarm()
+
+
+def simplify_expression(cf, timeout=SIMPLIFY_TIMEOUT):
     """
     Simplify expression to a string.
+    Maxima runs in a worker process so a pathological expression can not hang the miner,
+    when it takes longer than timeout seconds the pool is killed and recreated on next use.
 
     Args:
         cf: Expression.
+        timeout (float): Seconds to wait for the simplification.
+
+    Returns:
+        str or None: Simplified expression.
+    """
+    return simplify_string(str(cf), timeout)
+
+
+@lru_cache(maxsize=65536)
+def simplify_string(s, timeout=SIMPLIFY_TIMEOUT):
+    """
+    Simplifies an expression string in the simplification pool, memoized since
+    full_simplify is the most expensive Sage call and closed forms recur across sequences.
+    Timeouts are memoized as well, the same expression would time out again.
+
+    Args:
+        s (str): Expression.
+        timeout (float): Seconds to wait for the simplification.
 
     Returns:
         str or None: Simplified expression.
     """
+    global SIMPLIFY_POOL
+    if SIMPLIFY_POOL is None:
+        SIMPLIFY_POOL = SIMPLIFY_CONTEXT.Pool(processes=SIMPLIFY_WORKERS)
     try:
-        return str(cf.full_simplify())
-    except Exception:
+        return SIMPLIFY_POOL.apply_async(simplify_worker, (s,)).get(timeout=timeout)
+    except multiprocessing.TimeoutError:
+        SIMPLIFY_POOL.terminate()
+        SIMPLIFY_POOL = None
         return
 
 
-def formula_match_regex(RE, formulas):
+def formula_match_strings(patterns, formulas):
+    """
+    Matches every formula to the patterns.
+    Args:
+        patterns (tuple): Compiled regular expression patterns.
+        formulas (list): List of formulas in str format.
+    Returns:
+        List of matched formulas in str format.
+    """
+    return [r_formula for formula in formulas if (r_formula := regex_match_one(patterns, formula)) is not None]
+
+
+def formula_expressions(formula_strs):
     """
-    Matches a formula to a regex then validates it as an expression.
+    Validates matched formulas as expressions.
     Args:
-        List of formulas in str format.
+        formula_strs (list): List of matched formulas in str format.
     Returns:
         List of valid expressions.
     """
     matched = []
-    for formula in formulas:
-        if (r_formula := regex_match_one(RE, formula)) is not None:
-            try:
-                matched.append(string_to_expression(r_formula))
-            except Exception:
-                pass
+    for r_formula in formula_strs:
+        try:
+            matched.append(string_to_expression(r_formula))
+        except Exception:
+            pass
     return matched if matched else None
 
 
+def normalize_formula(s):
+    """
+    Removes the whitespace of a formula so equal strings can be matched without SageMath.
+
+    Args:
+        s (str): Formula.
+
+    Returns:
+        str: Normalized formula.
+    """
+    return WHITESPACE_RE.sub('', s)
+
+
 def formula_match_exp(formula_exps, closed_form_exp):
     """
     Matches every formula expression to a closed form expression.
@@ -111,6 +299,10 @@ def formula_match_exp(formula_exps, closed_form_exp):
     Returns:
         bool: True if there is a match.
     """
+    # Sage prints equal parsed expressions identically, a string hit spares the symbolic comparisons
+    closed_form_str = str(closed_form_exp)
+    if any(str(f_exp) == closed_form_str for f_exp in formula_exps):
+        return True
     #for f_exp in formula_exps:
     #    try:
     #        if f_exp == closed_form_exp:
@@ -120,20 +312,257 @@ def formula_match_exp(formula_exps, closed_form_exp):
     #return False
     return any(f_exp == closed_form_exp for f_exp in formula_exps)
 
-def get_sequence(sequence_id):
+def throttle(rate=MAX_REQUESTS_PER_SECOND):
+    """
+    Blocks until the next request to OEIS is allowed, spacing the requests of every
+    download thread so that at most rate are started per second.
+
+    Args:
+        rate (float): Maximum requests per second.
+    """
+    global NEXT_REQUEST_TIME
+    with THROTTLE_LOCK:
+        now = time.monotonic()
+        wait = NEXT_REQUEST_TIME - now
+        NEXT_REQUEST_TIME = max(now, NEXT_REQUEST_TIME) + 1 / rate
+    if wait > 0:
+        time.sleep(wait)
+
+
+def get_raw_sequence(sequence_id, session=SESSION):
+    """
+    Downloads the OEIS sequence information for the given ID from the OEIS website.
+
+    Args:
+        sequence_id (str): The OEIS sequence ID.
+        session (requests.Session): Session whose connection pool is reused.
+
+    Returns:
+        bytes or None: The raw JSON response or None if fetching fails.
+    """
+    throttle()
+    try:
+        response = session.get(OEIS_SEARCH_URL.format(sequence_id), timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response.content
+    except Exception:
+        return None
+
+
+def parse_sequence(content):
+    """
+    Parses a raw OEIS JSON response.
+
+    Args:
+        content (bytes): The raw JSON response.
+
+    Returns:
+        dict or None: The sequence information in dictionary format or None if it is not valid JSON.
+    """
+    try:
+        return json_loads(content)
+    except Exception:
+        return None
+
+
+def get_sequence(sequence_id, session=SESSION):
     """
     Fetches the OEIS sequence information for the given ID from the OEIS website.
 
     Args:
         sequence_id (str): The OEIS sequence ID.
+        session (requests.Session): Session whose connection pool is reused.
 
     Returns:
         dict or None: The sequence information in dictionary format or None if fetching fails.
     """
+    if (content := get_raw_sequence(sequence_id, session)) is not None:
+        return parse_sequence(content)
+    return None
+
+
+def load_zstd_dictionary():
+    """
+    Builds the zstd contexts of the sequence cache, using the trained dictionary if present.
+    """
+    global ZCTX_C, ZCTX_D
+    if os.path.isfile(ZDICT_PATH):
+        with open(ZDICT_PATH, 'rb') as fp:
+            zdict = zstd.ZstdCompressionDict(fp.read())
+        ZCTX_C = zstd.ZstdCompressor(level=ZSTD_LEVEL, dict_data=zdict)
+        ZCTX_D = zstd.ZstdDecompressor(dict_data=zdict)
+    else:
+        ZCTX_C = zstd.ZstdCompressor(level=ZSTD_LEVEL)
+        ZCTX_D = ZCTX_D_PLAIN
+
+
+load_zstd_dictionary()
+
+
+def train_zstd_dictionary(samples=ZDICT_SAMPLES, size=ZDICT_SIZE):
+    """
+    Trains a zstd dictionary on a random sample of cached sequences and stores it in ZDICT_PATH.
+    An existing dictionary is never overwritten, files compressed with it could not be read back.
+
+    Args:
+        samples (int): Number of cached sequences to sample.
+        size (int): Dictionary size in bytes.
+    """
+    if os.path.isfile(ZDICT_PATH):
+        sys.stderr.write(f"Dictionary {ZDICT_PATH} already exists, refusing to overwrite it...\n")
+        sys.stderr.flush()
+        return
+    index = cached_sequence_index()
+    if not index:
+        sys.stderr.write("No cached sequences to train the dictionary on...\n")
+        sys.stderr.flush()
+        return
+    # Trained on the cached bytes themselves, the layout of the OEIS responses is what gets compressed
+    sequence_ids = random.sample(sorted(index), min(samples, len(index)))
+    sample_blobs = [read_cached_sequence(sequence_id) for sequence_id in tqdm(sequence_ids)]
     try:
-        response = requests.get(f"https://oeis.org/search?fmt=json&q=id:{sequence_id}")
-        return json.loads(response.content)
+        zdict = zstd.train_dictionary(size, sample_blobs)
+    except zstd.ZstdError as e:
+        sys.stderr.write(f"Could not train the dictionary on {len(sample_blobs)} sequences: {e}\n")
+        sys.stderr.flush()
+        return
+    with open(f"{ZDICT_PATH}.tmp", 'wb') as fp:
+        fp.write(zdict.as_bytes())
+    os.replace(f"{ZDICT_PATH}.tmp", ZDICT_PATH)
+    load_zstd_dictionary()
+    sys.stderr.write(f"Trained {ZDICT_PATH} on {len(sample_blobs)} sequences...\n")
+    sys.stderr.flush()
+
+
+def extract_fields(raw_data):
+    """
+    Extracts the fields the miner uses from an OEIS response.
+    The cache keeps the whole response, it mirrors the OEIS data submodule and other fields may be needed later.
+
+    Args:
+        raw_data (dict): The parsed OEIS response.
+
+    Returns:
+        tuple: (name, data, keyword, formula, xref), formula and xref are None when missing.
+    """
+    result = raw_data['results'][0]
+    return result['name'], result['data'], result['keyword'], result.get('formula'), result.get('xref')
+
+
+def cached_sequence_paths(sequence_id, mode=SEQUENCE_MODE):
+    """
+    Lists the candidate cache file paths of a sequence for a given storage mode.
+
+    Args:
+        sequence_id (str): The OEIS sequence ID.
+        mode (str): The storage mode, also used as file extension.
+
+    Returns:
+        list: File paths, the current sharded layout last.
+    """
+    return [
+        os.path.join(OEIS_DATA_DIR, f'{sequence_id}.{mode}'),
+        os.path.join(OEIS_DATA_DIR, sequence_id[1:4], f'{sequence_id}.{mode}'),
+        os.path.join(OEIS_DATA_DIR, 'sequences', sequence_id[1:4], f'{sequence_id}.{mode}')
+    ]
+
+
+def decompress_cached_sequence(comp_data):
+    """
+    Decompresses the content of a cache file, the format is probed from its leading bytes
+    so a file is read correctly whatever its extension says.
+
+    Args:
+        comp_data (bytes): The file content.
+
+    Returns:
+        bytes: The JSON document as it was cached.
+
+    Raises:
+        ValueError: The file is lzo compressed and python-lzo is not installed.
+    """
+    magic = comp_data[:4]
+    if magic == ZSTD_MAGIC:
+        try:
+            return ZCTX_D.decompress(comp_data)
+        except zstd.ZstdError:
+            # Written before the dictionary was trained
+            return ZCTX_D_PLAIN.decompress(comp_data)
+    elif magic.lstrip()[:1] in (b'{', b'['):
+        return bytes(comp_data)
+    elif lzo is None:
+        raise ValueError("not a zstd or JSON cache file and python-lzo is not installed")
+    elif magic.startswith(GZIP_MAGIC):
+        return lzo.decompress(gzip.decompress(comp_data))
+    else:
+        return lzo.decompress(comp_data)
+
+
+def scan_cached_sequences():
+    """
+    Scans every cache layout once and maps each cached sequence ID to its file,
+    files in the current storage mode take precedence over legacy ones.
+
+    Returns:
+        dict: sequence_id -> (file_path, mode).
+    """
+    modes = {mode: rank for rank, mode in enumerate([SEQUENCE_MODE] + LEGACY_SEQUENCE_MODES)}
+    directories = []
+    for parent in [OEIS_DATA_DIR, os.path.join(OEIS_DATA_DIR, 'sequences')]:
+        if os.path.isdir(parent):
+            directories.append(parent)
+            directories += [entry.path for entry in os.scandir(parent) if entry.name.isdigit() and entry.is_dir()]
+    index = {}
+    for directory in directories:
+        for entry in os.scandir(directory):
+            sequence_id, _, mode = entry.name.partition('.')
+            if mode in modes and (sequence_id not in index or modes[mode] < modes[index[sequence_id][1]]):
+                index[sequence_id] = (entry.path, mode)
+    return index
+
+
+def cached_sequence_index():
+    """
+    Returns the in-memory index of cached sequences, scanning the cache on first use.
+    """
+    global CACHE_INDEX
+    if CACHE_INDEX is None:
+        CACHE_INDEX = scan_cached_sequences()
+    return CACHE_INDEX
+
+
+def read_cached_sequence(sequence_id):
+    """
+    Reads a previously cached OEIS sequence from the local storage without parsing it.
+    Files written in a legacy mode are still read.
+
+    Args:
+        sequence_id (str): The OEIS sequence ID.
+
+    Returns:
+        bytes or None: The cached JSON document or None if not found or unreadable,
+        so a damaged file is downloaded again.
+    """
+    # The sharded layout is opened directly, the index of every layout is only scanned on a miss
+    file_path = os.path.join(OEIS_DATA_DIR, 'sequences', sequence_id[1:4], f'{sequence_id}.{SEQUENCE_MODE}')
+    mode = SEQUENCE_MODE
+    try:
+        fp = open(file_path, 'rb')
+    except FileNotFoundError:
+        if (entry := cached_sequence_index().get(sequence_id)) is None:
+            return None
+        file_path, mode = entry
+        fp = open(file_path, 'rb')
+    try:
+        with fp:
+            # Large zstd files are decompressed straight from a memory map, skipping the read copy
+            if mode == 'zst' and os.fstat(fp.fileno()).st_size >= MMAP_THRESHOLD:
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return decompress_cached_sequence(mm)
+            return decompress_cached_sequence(fp.read())
     except Exception as e:
+        sys.stderr.write(f"Ignoring unreadable cache file {file_path}: {e}\n")
+        sys.stderr.flush()
         return None
 
 
@@ -147,46 +576,56 @@ def load_cached_sequence(sequence_id):
     Returns:
         dict or None: The cached sequence data in dictionary format or None if not found.
     """
-    file_paths = [
-        os.path.join(OEIS_DATA_DIR, f'{sequence_id}.{SEQUENCE_MODE}'),
-        os.path.join(OEIS_DATA_DIR, sequence_id[1:4], f'{sequence_id}.{SEQUENCE_MODE}'),
-        os.path.join(OEIS_DATA_DIR, 'sequences', sequence_id[1:4], f'{sequence_id}.{SEQUENCE_MODE}')
-    ]
-    for file_path in file_paths:
-        if os.path.isfile(file_path):
-            with open(file_path, 'rb') as fp:
-                if SEQUENCE_MODE == 'lzo':
-                    return json.loads(lzo.decompress(fp.read()))
-                elif SEQUENCE_MODE == 'lzogzip':
-                    return json.loads(lzo.decompress(gzip.decompress(fp.read())))
-                else:
-                    return json.loads(fp.read())
-    return None
+    if (content := read_cached_sequence(sequence_id)) is None:
+        return None
+    try:
+        return json_loads(content)
+    except ValueError:
+        # Truncated by an interrupted write of an older version
+        return None
 
 
 def remove_cached_sequence(sequence_id):
     """
     Remove a given cache object.
     """
-    file_paths = [
-        os.path.join(OEIS_DATA_DIR, f'{sequence_id}.{SEQUENCE_MODE}'),
-        os.path.join(OEIS_DATA_DIR, sequence_id[1:4], f'{sequence_id}.{SEQUENCE_MODE}'),
-        os.path.join(OEIS_DATA_DIR, 'sequences', sequence_id[1:4], f'{sequence_id}.{SEQUENCE_MODE}')
-    ]
-    for file_path in file_paths:
-        if os.path.isfile(file_path):
-            os.remove(file_path)
-            return True
-    return False
-    
+    if CACHE_INDEX is not None:
+        CACHE_INDEX.pop(sequence_id, None)
+    removed = False
+    for mode in [SEQUENCE_MODE] + LEGACY_SEQUENCE_MODES:
+        for file_path in cached_sequence_paths(sequence_id, mode):
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+                removed = True
+    return removed
+
+
+def migrate_cached_sequences():
+    """
+    Moves cached sequences from the flat and legacy layouts into the sharded sequences/NNN/ layout.
+    """
+    global CACHE_INDEX
+    moved = 0
+    for sequence_id, (file_path, mode) in tqdm(scan_cached_sequences().items()):
+        directory_path = os.path.join(OEIS_DATA_DIR, 'sequences', sequence_id[1:4])
+        target_path = os.path.join(directory_path, os.path.basename(file_path))
+        if file_path != target_path:
+            os.makedirs(directory_path, exist_ok=True)
+            os.replace(file_path, target_path)
+            moved += 1
+    CACHE_INDEX = None
+    sys.stderr.write(f"Moved {moved} cached sequences...\n")
+    sys.stderr.flush()
+
 
-def save_cached_sequence(sequence_id, data):
+def save_cached_sequence(sequence_id, content):
     """
-    Saves the OEIS sequence data to the local cache.
+    Saves the raw OEIS response to the local cache.
+    The file is written to a temporary file and renamed into place so it is never left half written.
 
     Args:
         sequence_id (str): The OEIS sequence ID.
-        data (dict): The sequence data to be cached.
+        content (bytes): The raw JSON response to be cached.
     """
     n = sequence_id[1:4]
     directory_path = f"{OEIS_DATA_DIR}/sequences/{n}"
@@ -194,96 +633,266 @@ def save_cached_sequence(sequence_id, data):
         os.makedirs(directory_path)
         
     file_path = os.path.join(directory_path, f'{sequence_id}.{SEQUENCE_MODE}')
-    with open(file_path, 'wb') as fp:
-        raw_data = json.dumps(data)
-        if SEQUENCE_MODE == 'lzo':
-            comp_data = lzo.compress(raw_data, 9)
-            fp.write(comp_data)
-            return len(raw_data), len(comp_data)
-        elif SEQUENCE_MODE == 'lzogzip':
-            comp_data = gzip.compress(lzo.compress(raw_data, 9), 9)
-            fp.write(comp_data)
-            return len(raw_data), len(comp_data)
-        else:
-            fp.write(raw_data.encode("utf8"))
-            return len(raw_data), 0
+    if CACHE_INDEX is not None:
+        CACHE_INDEX[sequence_id] = (file_path, SEQUENCE_MODE)
+    if SEQUENCE_MODE == 'zst':
+        comp_data = ZCTX_C.compress(content)
+    elif SEQUENCE_MODE == 'lzo':
+        comp_data = lzo.compress(content, 9)
+    elif SEQUENCE_MODE == 'lzogzip':
+        comp_data = gzip.compress(lzo.compress(content, 9), 9)
+    else:
+        comp_data = content
+    with open(f"{file_path}.tmp", 'wb') as fp:
+        fp.write(comp_data)
+    os.replace(f"{file_path}.tmp", file_path)
+    return len(content), (len(comp_data) if comp_data is not content else 0)
 
 
+def fetch_sequences(sequence_ids, use_cache=True, workers=FETCH_WORKERS, depth=FETCH_DEPTH, session=SESSION):
+    """
+    Fetches sequences in order, downloading the ones missing from the local cache
+    ahead of time in a bounded thread pool so network latency overlaps the processing.
+
+    Args:
+        sequence_ids (iterable): OEIS sequence IDs.
+        use_cache (bool): Serve sequences from the local cache when available.
+        workers (int): Number of concurrent downloads.
+        depth (int): Maximum number of sequences fetched ahead.
+        session (requests.Session): Session shared by the download threads.
 
-@cache
+    Yields:
+        tuple: (sequence_id, raw_data, content), raw_data is None if fetching fails and
+        content holds the downloaded response to be cached (None if it came from the cache).
+    """
+    def resolve(sequence_id, raw_data, future):
+        if future is None:
+            return sequence_id, raw_data, None
+        if (content := future.result()) is None or (raw_data := parse_sequence(content)) is None:
+            return sequence_id, None, None
+        return sequence_id, raw_data, content
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for sequence_id in sequence_ids:
+            if use_cache and (cached_data := load_cached_sequence(sequence_id)) is not None:
+                pending.append((sequence_id, cached_data, None))
+            else:
+                pending.append((sequence_id, None, executor.submit(get_raw_sequence, sequence_id, session)))
+            if len(pending) >= depth:
+                yield resolve(*pending.popleft())
+        while pending:
+            yield resolve(*pending.popleft())
+
+
+@lru_cache(maxsize=100_000)
+def guess_cfinite(lst, use_bm=False):
+    """
+    Guesses a C-finite recurrence for an integer sequence.
+
+    Args:
+        lst (tuple): Tuple of integers representing the sequence.
+
+    Returns:
+        tuple or None: (C-finite sequence, algorithm, field) or None if no recurrence is found.
+    """
+    algorithms = ALGORITHMS + ["bm"] if use_bm else ALGORITHMS
+    for field, C in CFINITE_RINGS:
+        for algo in algorithms:
+            if (s := C.guess(list(lst), algorithm=algo)) != 0:
+                return s, algo, str(field)
+
+
+@lru_cache(maxsize=100_000)
 def guess_sequence(lst, use_bm=False):
     """
     Guesses the closed form of an integer sequence.
 
     Args:
-        lst (list): List of integers representing the sequence.
+        lst (tuple): Tuple of integers representing the sequence.
 
     Returns:
         object or None: The guessed closed form or None if no closed form is found.
     """
-    if use_bm: ALGORITHMS.append("bm")
-    for field in [ZZ,QQ]:
-        C = CFiniteSequences(field)
-        for algo in ALGORITHMS:
-            if (s := C.guess(list(lst), algorithm=algo)) != 0:
-                try:
-                    return s.closed_form(), algo, str(field)
-                except Exception:
-                    return 
+    if (guess := guess_cfinite(lst, use_bm=use_bm)) is not None:
+        s, algo, field = guess
+        try:
+            return s.closed_form(), algo, field
+        except Exception:
+            return 
+
+
+def guess_cache_key(sdata, use_bm=False):
+    """
+    Hashes the terms of a sequence together with the guessing algorithms and the settings
+    of check_sequence into a guess_cache key, results of older settings are guessed again.
+
+    Args:
+        sdata (str): Comma separated terms of the sequence.
+        use_bm (bool): Berlekamp-Massey is among the algorithms.
+
+    Returns:
+        bytes: 16 byte digest.
+    """
+    algorithms = ALGORITHMS + ["bm"] if use_bm else ALGORITHMS
+    return hashlib.blake2b(f"{GUESS_VERSION}|{PREFLIGHT_TERMS}|{','.join(algorithms)}|{sdata}".encode(), digest_size=16).digest()
+
+
+def cached_guess(cursor, key):
+    """
+    Looks up a previous check_sequence result in the guess_cache table.
+
+    Args:
+        cursor (sqlite3.Cursor): SQLite database cursor.
+        key (bytes): The guess_cache_key of the sequence.
+
+    Returns:
+        tuple: (hit, result), result is None when no closed form was found.
+    """
+    row = cursor.execute("SELECT closed_form, algo, field FROM guess_cache WHERE data_hash=?;", (key,)).fetchone()
+    if row is None:
+        return False, None
+    if row[0] is None:
+        return True, None
+    if (cf := closed_form_from_string(row[0])) is None:
+        return False, None
+    return True, (cf, row[1], row[2])
 
 
-def check_sequence(data, items=10, use_bm=False):
+def closed_form_from_string(s):
+    """
+    Rebuilds a closed form in the variable n from its string, as returned by check_sequence.
+    Constant closed forms evaluate to plain numbers, they are coerced to symbolic expressions
+    like the ones check_sequence returns.
+
+    Args:
+        s (str): The closed form.
+
+    Returns:
+        Expression or None: The closed form or None if it can not be parsed.
+    """
+    try:
+        return SR(sage_eval(s, locals=CLOSED_FORM_LOCALS))
+    except Exception:
+        return
+
+
+def check_sequence(sdata, items=10, use_bm=False):
     """
     Checks a small portion of terms of the sequence first and then the whole sequence.
+    Only the first terms are parsed unless they have a closed form, and they are only
+    handed to Sage when a Berlekamp-Massey pass finds a recurrence short enough to be confirmed.
+    When the recurrence guessed from the first terms already generates the remaining
+    terms, the guess on the whole sequence would find the same one and is skipped.
+    The whole sequence is only guessed when that recurrence still holds for the next
+    PREFLIGHT_TERMS terms, recurrences of a higher order than the first terms can reveal are missed.
 
     Args:
-        data (list): List of integers representing the sequence.
+        sdata (str): Comma separated terms of the sequence.
         items (int): Number of items to check initially.
 
     Returns:
         object or None: The guessed closed form or None if no closed form is found.
     """
-    first_terms_data = data[:items]
-    if len(first_terms_data) > 7 and (result := guess_sequence(tuple(first_terms_data),use_bm=use_bm)) is not None:
-        return guess_sequence(tuple(data), use_bm = use_bm)
+    first_terms_data = tuple(parse_terms(sdata, items))
+    if (len(first_terms_data) > 7 and plausibly_cfinite(first_terms_data)
+            and (guess := guess_cfinite(first_terms_data, use_bm=use_bm)) is not None):
+        data = parse_terms(sdata)
+        coefficients = guess[0].coefficients()
+        start = len(first_terms_data)
+        if not recurrence_holds(coefficients, data[:start + PREFLIGHT_TERMS], start):
+            return None
+        if recurrence_holds(coefficients, data, start + PREFLIGHT_TERMS):
+            return guess_sequence(first_terms_data, use_bm=use_bm)
+        return guess_sequence(tuple(data), use_bm=use_bm)
+
+
+@lru_cache(maxsize=8192)
+def compile_expression(s, domain=None):
+    """
+    Compiles an expression string with fast_callable, the same closed form recurs across many sequences.
+
+    Args:
+        s (str): Expression in x.
+        domain: Ring the expression is evaluated in (QQ, a RealField), None for the generic symbolic domain.
+
+    Returns:
+        object or None: The compiled expression or None if it can not be compiled.
+    """
+    if (exp := string_to_expression(s)) is None:
+        return None
+    try:
+        if domain is None:
+            return fast_callable(exp, vars={'x': X})
+        return fast_callable(exp, vars={'x': X}, domain=domain)
+    except Exception:
+        return None
 
 
-def list_compare(A,B):
+def evaluate_exact(exp, count):
     """
-    Compare elementwise two lists.
+    Evaluates an expression at 0..count-1 with a fast_callable over QQ, exact and cheap for
+    the common polynomial, rational and geometric closed forms.
+
     Args:
-        Lists: A,B.
+        exp: Expression.
+        count (int): Number of terms.
+
     Returns:
-        Boolean
-    Comment:
-        Still faster than: return all(A[n] == B[n] for n in range(0, len(A)))
+        list or None: The values rounded to integers, None if the expression is not rational.
     """
-    for n in range(0,len(A)):
-        if A[n] != B[n]: 
-            return False
-    return True
+    if (fexp := compile_expression(str(exp), QQ)) is None:
+        return None
+    try:
+        return [int(fexp(n).round()) for n in range(count)]
+    except Exception:
+        return None
+
+
+def evaluate_real(exp, count, prec):
+    """
+    Evaluates an expression at 0..count-1 with a fast_callable over a RealField,
+    which runs MPFR arithmetic instead of symbolic operations on every term.
+
+    Args:
+        exp: Expression.
+        count (int): Number of terms.
+        prec (int): Bits of precision, rounded up to a multiple of 64 so compilations are shared.
+
+    Returns:
+        list or None: The values rounded to integers, None if the expression has no real evaluation.
+    """
+    if (fexp := compile_expression(str(exp), RealField((prec + 63) // 64 * 64))) is None:
+        return None
+    try:
+        return [int(fexp(n).round()) for n in range(count)]
+    except Exception:
+        return None
 
 
 def expression_verify_sequence(exp, ground_truth_data):
     """
     Evaluates an expression and generates a sequence to check against ground truth data.
+    Tries exact rational evaluation first, then a RealField precise enough for the largest term,
+    then the generic symbolic path.
     Args:
         Expression, ground_truth_data
     Returns:
         Boolean
     """
     lg = len(ground_truth_data)
-    try:
-        fexp = fast_callable(exp, vars={'x':var('x')})
-    except:
-        return False
-    e_data = []
-    for n in tqdm(range(0, lg+1)):
-        fx = fexp(n)
-        try:
-            e_data.append(int(fx.round()))
-        except:
-            e_data.append(fx)
+    # Holds the largest term exactly with VERIFY_GUARD_BITS left for the rounding error
+    prec = max((abs(t) for t in ground_truth_data), default=0).bit_length() + VERIFY_GUARD_BITS
+    if (e_data := evaluate_exact(exp, lg + 1)) is None and (e_data := evaluate_real(exp, lg + 1, prec)) is None:
+        if (fexp := compile_expression(str(exp))) is None:
+            return False
+        e_data = []
+        for n in range(lg + 1):
+            fx = fexp(n)
+            try:
+                e_data.append(int(fx.round()))
+            except:
+                e_data.append(fx)
     return list_compare(e_data[:lg - 1],ground_truth_data) or list_compare(e_data[1:], ground_truth_data)
 
 def process_file():
@@ -295,6 +904,53 @@ def process_file():
         print(sequence_id, get_sequence(sequence_id))
 
 
+def sequence_number(sequence_id):
+    """
+    Returns the numeric part of an OEIS sequence ID.
+    The sequence table is prepopulated in order, so it is also the rowid of the sequence
+    (aliased by the n column in databases created by this version). Updates still match
+    the id as well, older databases give no guarantee that the two stay in step.
+
+    Args:
+        sequence_id (str): The OEIS sequence ID.
+
+    Returns:
+        int: The sequence number.
+    """
+    return int(sequence_id[1:])
+
+
+def connect_database():
+    """
+    Opens the OEIS database in WAL mode with pragmas tuned for the write heavy workload.
+
+    Returns:
+        sqlite3.Connection: The database connection.
+    """
+    conn = sqlite3.connect(OEIS_DB_PATH)
+    cursor = conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    return conn
+
+
+def update_schema(conn):
+    """
+    Creates the tables and partial indexes added after the initial schema, databases created by older versions get them too.
+
+    Args:
+        conn (sqlite3.Connection): The database connection.
+    """
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS guess_cache(data_hash BLOB PRIMARY KEY, closed_form TEXT, algo TEXT, field TEXT);")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_seq_unprocessed ON sequence(id) WHERE {UNPROCESSED_CONDITION};")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_seq_reprocess ON sequence(id) WHERE {REPROCESS_CONDITION};")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_seq_uncheck ON sequence(id) WHERE {UNCHECKED_CONDITION};")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_seq_parsed ON sequence(id) WHERE {PARSED_CONDITION};")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_blacklist ON blacklist(sequence_id);")
+    conn.commit()
+
+
 def create_database(length):
     """
     Creates a blank database with a table for storing OEIS sequence information.
@@ -305,25 +961,38 @@ def create_database(length):
     if os.path.isfile(OEIS_DB_PATH):
         sys.stderr.write(f'Using database {OEIS_DB_PATH}...\n')
         sys.stderr.flush()
+        conn = connect_database()
+        update_schema(conn)
+        conn.close()
         return
 
-    sys.stderr.write("Creating database {OEIS_DB_PATH}...\n")
+    sys.stderr.write(f"Creating database {OEIS_DB_PATH}...\n")
     sys.stderr.flush()
 
-    conn = sqlite3.connect(OEIS_DB_PATH)
+    # Bulk loaded without a journal into a temporary file, moved into place once complete
+    tmp_path = f"{OEIS_DB_PATH}.tmp"
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
     cur = conn.cursor()
-    cur.execute("CREATE TABLE sequence(id, name TEXT, data TEXT, formula TEXT, closed_form TEXT, "
+    cur.execute("PRAGMA journal_mode=OFF;")
+    cur.execute("PRAGMA synchronous=OFF;")
+    cur.execute("CREATE TABLE sequence(n INTEGER PRIMARY KEY, id TEXT, name TEXT, data TEXT, formula TEXT, closed_form TEXT, "
                 "simplified_closed_form TEXT, new INT, regex_match INT, parsed_formulas TEXT, keyword TEXT, xref TEXT, algo TEXT, field TEXT, check_cf INT, not_easy INT, hard INT);")
-    cur.execute("CREATE TABLE matches(id_a TEXT, id_b TEXT, formula_a TEXT, formula_b, TEXT);")
+    cur.execute("CREATE TABLE matches(id_a TEXT, id_b TEXT, formula_a TEXT, formula_b TEXT);")
     cur.execute("CREATE TABLE blacklist(sequence_id TEXT);")
 
-    for n in tqdm(range(1, length + 1)):
-        cur.execute("INSERT INTO sequence (id) VALUES ('A%06d');" % n)
-
-    for sequence_id in tqdm(BLACKLIST):
-        cur.execute("INSERT INTO blacklist (sequence_id) VALUES(?);", (sequence_id,))
-
+    cur.execute("BEGIN;")
+    cur.executemany("INSERT INTO sequence (n, id) VALUES (?, ?);", ((n, "A%06d" % n) for n in tqdm(range(1, length + 1))))
+    cur.executemany("INSERT INTO blacklist (sequence_id) VALUES (?);", ((sequence_id,) for sequence_id in BLACKLIST))
     conn.commit()
+    conn.close()
+    os.replace(tmp_path, OEIS_DB_PATH)
+
+    # Switches the new database to WAL, the journal mode is persistent
+    conn = connect_database()
+    update_schema(conn)
+    conn.close()
 
 
 def add_to_blacklist(sequence_ids):
@@ -332,29 +1001,104 @@ def add_to_blacklist(sequence_ids):
     Args:
        string of ids.
     """
-    conn = sqlite3.connect(OEIS_DB_PATH)
+    conn = connect_database()
     cursor = conn.cursor()
-    for sequence_id in re.findall(OEIS_XREF_REGEX, sequence_ids):
+    for sequence_id in OEIS_XREF_RE.findall(sequence_ids):
         cursor.execute("INSERT INTO blacklist (sequence_id) VALUES (?);", (sequence_id,))
     conn.commit()
 
 
-def yield_unprocessed_ids(cursor, reprocess = False):
+def flush_writes(conn, pending):
+    """
+    Writes the buffered rows with one executemany per statement in a single transaction.
+
+    Args:
+        conn (sqlite3.Connection): Database connection.
+        pending (dict): Parameterized statement -> buffered parameter tuples, emptied afterwards.
+    """
+    with conn:
+        for sql, rows in pending.items():
+            conn.executemany(sql, rows)
+    pending.clear()
+
+
+def database_writer(write_queue, batch_size=UPDATE_BATCH_SIZE):
+    """
+    Consumes (sql, params) items from the queue and writes them in batches on its own
+    connection, so commits never block the thread doing the Sage work.
+    Stops after flushing when it receives None.
+
+    Args:
+        write_queue (queue.Queue): Queue of (sql, params) tuples.
+        batch_size (int): Number of rows written per transaction.
+    """
+    conn = connect_database()
+    pending = {}
+    count = 0
+    while True:
+        item = write_queue.get()
+        if item is not None:
+            sql, params = item
+            pending.setdefault(sql, []).append(params)
+            count += 1
+        if count >= batch_size or (item is None and pending):
+            try:
+                flush_writes(conn, pending)
+            except sqlite3.Error as e:
+                sys.stderr.write(f"Failed writing {count} rows: {e}\n")
+                sys.stderr.flush()
+                pending.clear()
+            count = 0
+        if item is None:
+            break
+    conn.close()
+
+
+def start_database_writer():
+    """
+    Starts the database writer thread.
+
+    Returns:
+        tuple: (write_queue, thread).
+    """
+    write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+    thread = threading.Thread(target=database_writer, args=(write_queue,), daemon=True)
+    thread.start()
+    return write_queue, thread
+
+
+def stop_database_writer(write_queue, thread):
+    """
+    Flushes the pending writes and waits for the database writer thread to finish.
+    """
+    write_queue.put(None)
+    thread.join()
+
+
+def yield_unprocessed_ids(cursor, reprocess = False, ignore_blacklist = False, page_size = ID_PAGE_SIZE):
     """
     Yields a generator of unvisited sequences from the database.
 
     Args:
         cursor (sqlite3.Cursor): SQLite database cursor.
+        ignore_blacklist (bool): Also yield sequences in the blacklist table.
+        page_size (int): Number of ids fetched per query.
 
     Yields:
         str: The next unvisited sequence ID.
     """
-    if reprocess:
-        cursor.execute("SELECT id FROM sequence WHERE (closed_form IS NULL or closed_form = '') and name is not NULL;")
-    else:
-        cursor.execute("SELECT id FROM sequence WHERE name IS NULL;")
-    for row in cursor.fetchall():
-        yield row[0]
+    condition = REPROCESS_CONDITION if reprocess else UNPROCESSED_CONDITION
+    if not ignore_blacklist:
+        condition += " AND id NOT IN (SELECT sequence_id FROM blacklist)"
+    # Page through the ids so the whole result set is never held in memory and
+    # updates made by the caller between pages can not disturb a running query.
+    # Ids are zero padded, so paging by id walks the partial index of the condition in order.
+    last_id = ''
+    while (rows := cursor.execute(f"SELECT id FROM sequence WHERE {condition} AND id > ? ORDER BY id LIMIT ?;",
+                                  (last_id, page_size)).fetchall()):
+        for row in rows:
+            yield row[0]
+        last_id = rows[-1][0]
 
 
 def yield_blacklist(cursor):
@@ -365,8 +1109,7 @@ def yield_blacklist(cursor):
     Yields:
         str: sequence id.   
     """
-    cursor.execute("select sequence_id from blacklist order by sequence_id;")
-    for row in cursor.fetchall():
+    for row in cursor.execute("select sequence_id from blacklist order by sequence_id;"):
         yield row[0]
 
 
@@ -377,15 +1120,12 @@ def download_only_remaining(start,end):
         start
         end
     """
-    conn = sqlite3.connect(OEIS_DB_PATH)
-    cursor = conn.cursor()
     fails = 0
-    for n in tqdm(range(start,end)):
-        fails = 0
-        sequence_id = "A%06d" % n
-        raw_data = get_sequence(sequence_id)
+    sequence_ids = ["A%06d" % n for n in range(start, end)]
+    for sequence_id, raw_data, content in tqdm(fetch_sequences(sequence_ids, use_cache=False), total=len(sequence_ids)):
         if raw_data is not None:
-            bz,cz = save_cached_sequence(sequence_id, raw_data)
+            fails = 0
+            bz,cz = save_cached_sequence(sequence_id, content)
             print("sequence id:", sequence_id, bz, "uncompressed bytes", cz, "compressed_bytes")
         else:
             fails += 1
@@ -394,14 +1134,86 @@ def download_only_remaining(start,end):
             sys.exit(-1)
 
 
-def process_sequences(ignore_blacklist=False, quiet=False, reprocess=False):
+def check_sequence_worker(args):
+    """
+    Runs check_sequence in a process of the guessing pool.
+    The closed form is returned as a string, rebuilt with closed_form_from_string.
+
+    Args:
+        args (tuple): (sdata, use_bm).
+
+    Returns:
+        tuple or None: (closed form string, algorithm, field) or None if no closed form is found.
+    """
+    sdata, use_bm = args
+    if (cf_algo_field := check_sequence(sdata, use_bm=use_bm)) is not None:
+        cf, algo, field = cf_algo_field
+        return str(cf), algo, field
+
+
+def yield_guessed_sequences(cursor, items, pool, use_bm=False, batch_size=GUESS_BATCH_SIZE):
+    """
+    Attaches a closed form guess to fetched sequences. Each batch is looked up in
+    guess_cache and the misses are guessed in parallel by the pool, the next batch is
+    already being guessed while the caller works through the current one.
+
+    Args:
+        cursor (sqlite3.Cursor): SQLite database cursor.
+        items (iterable): (sequence_id, raw_data, content) tuples from fetch_sequences.
+        pool (multiprocessing.Pool): Guessing pool, None to guess inline in the caller.
+        use_bm (bool): Also try the Berlekamp-Massey algorithm.
+        batch_size (int): Number of sequences guessed per batch.
+
+    Yields:
+        tuple: (sequence_id, raw_data, content, guess), guess is (sdata, hit, result) or None when not guessed.
+        A closed form that can not be rebuilt from its string is not guessed either, the caller guesses it inline.
+    """
+    items = iter(items)
+    if pool is None:
+        yield from ((*item, None) for item in items)
+        return
+
+    def submit(batch):
+        # Cache lookups stay in this process, the pool only receives the terms to guess
+        guesses, misses = [], []
+        for sequence_id, raw_data, content in batch:
+            guess = None
+            if raw_data is not None:
+                _, sdata, keyword, _, _ = extract_fields(raw_data)
+                if keyword != 'allocated':
+                    hit, result = cached_guess(cursor, guess_cache_key(sdata, use_bm=use_bm))
+                    guess = (sdata, hit, result)
+                    if not hit:
+                        misses.append(len(guesses))
+            guesses.append(guess)
+        return batch, guesses, misses, pool.map_async(check_sequence_worker, [(guesses[i][0], use_bm) for i in misses], chunksize=1)
+
+    def resolve(batch, guesses, misses, async_result):
+        for i, result in zip(misses, async_result.get()):
+            if result is None:
+                guesses[i] = (guesses[i][0], False, None)
+            elif (cf := closed_form_from_string(result[0])) is not None:
+                guesses[i] = (guesses[i][0], False, (cf, result[1], result[2]))
+            else:
+                guesses[i] = None
+        return [(*item, guess) for item, guess in zip(batch, guesses)]
+
+    current = submit(batch) if (batch := list(islice(items, batch_size))) else None
+    while current is not None:
+        following = submit(batch) if (batch := list(islice(items, batch_size))) else None
+        yield from resolve(*current)
+        current = following
+
+
+def process_sequences(ignore_blacklist=False, quiet=False, reprocess=False, jobs=GUESS_WORKERS):
     """
     Processes sequences from the generator:
     - Fetches each unvisited sequence from the server or local cache.
     - Guesses its closed form and matches it to name and formula.
     - Saves everything to the database and prints statistics.
+    Closed forms are guessed in batches by a pool of jobs processes, inline when jobs is 1.
     """
-    conn = sqlite3.connect(OEIS_DB_PATH)
+    conn = connect_database()
     cursor = conn.cursor()
      
     fail_count = 0
@@ -413,197 +1225,230 @@ def process_sequences(ignore_blacklist=False, quiet=False, reprocess=False):
     m = 0
     check_cf = True
 
-    seq_BLACKLIST = [] if ignore_blacklist else sorted(set(BLACKLIST + list(yield_blacklist(cursor)))) 
+    sql = """UPDATE sequence SET name=?, data=?, formula=?, closed_form=?, simplified_closed_form=?, new=?, regex_match=?, parsed_formulas=?, keyword=?, xref=?, algo=?, field=?, check_cf=?, hard=?, not_easy=?  WHERE rowid=? AND id=?"""
+    guess_sql = "INSERT OR REPLACE INTO guess_cache(data_hash, closed_form, algo, field) VALUES (?, ?, ?, ?);"
+    # Forked before the writer and download threads start, Sage is already imported so workers start guessing right away
+    pool = multiprocessing.Pool(processes=jobs) if jobs > 1 else None
+    write_queue, writer = start_database_writer()
 
-    for n, sequence_id in enumerate(yield_unprocessed_ids(cursor, reprocess=reprocess)):
-        if sequence_id in seq_BLACKLIST:
-            continue
-    
-        is_hard = False
-        is_not_easy = False
-
-        t0 = time.time()
-        if not quiet:
-            sys.stderr.write("Processing: %s...           \r" % sequence_id)
-            sys.stderr.flush()
-        cached_data = load_cached_sequence(sequence_id)
-        if cached_data is not None:
-            raw_data = cached_data
-        else:
-            raw_data = get_sequence(sequence_id)
-            save_cached_sequence(sequence_id, raw_data)
-
-        if raw_data is not None:
-            fail_count = 0
-            proc = n + 1
-
-            if (keyword := raw_data['results'][0]['keyword']) == 'allocated':
-                if not quiet:
-                    print(sequence_id, keyword, "...")
-                remove_cached_sequence(sequence_id)
-                raw_data = get_sequence(sequence_id)
-                if (keyword := raw_data['results'][0]['keyword']) == 'allocated':
-                    continue
-                else:
-                    save_cached_sequence(sequence_id, raw_data)
-
-            name = raw_data['results'][0]['name']
-            sdata = raw_data['results'][0]['data']
-
-            is_hard = keyword.find("hard") > -1
-            is_not_easy = keyword.find("easy") == -1
-
-            data = [int(x) for x in sdata.split(",")]
-            xref = None
-            if 'xref' in raw_data['results'][0]:
-                xref = str(re.findall(OEIS_XREF_REGEX, str(raw_data['results'][0]['xref'])))
-            l_formula, formula = [], ''
-            if 'formula' in raw_data['results'][0]:
-                l_formula = raw_data['results'][0]['formula']
-                formula = json.dumps(l_formula)
-            if (rname := regex_match_one(OEIS_FORMULA_REGEX_2, name)) is not None:
-                l_formula.append(rname)
-
-            closed_form = ""
-            simplified_closed_form = ""
-            algo = None
-            field = None
-            is_new = False
-            v_regex_match = False
-            v_check_cf = None
-
-            if l_formula:
-                formula_exps = formula_match_regex(OEIS_FORMULA_REGEX_4, l_formula)
-            else:
-                formula_exps = []
+    # The blacklist table is filtered in SQL, the set catches entries added to lib/blacklist.py after the database was created
+    seq_BLACKLIST = set() if ignore_blacklist else set(BLACKLIST)
 
-            if (cf_algo_field := check_sequence(data, use_bm=reprocess)) is not None:
-                cf, algo, field = cf_algo_field
-                found_count += 1
-                closed_form = str(cf)
+    sequence_ids = (sequence_id for sequence_id in yield_unprocessed_ids(cursor, reprocess=reprocess, ignore_blacklist=ignore_blacklist)
+                    if sequence_id not in seq_BLACKLIST)
 
-                if len(closed_form) > 1 and not (cf.is_integer() and cf.is_constant()):
-                    simplified_closed_form = simplify_expression(cf)
-
-                    is_new = (closed_form is not None and closed_form not in name and closed_form not in formula)
-                    is_new |= (simplified_closed_form is not None and closed_form not in simplified_closed_form and 
-                        simplified_closed_form not in name and simplified_closed_form not in formula)            
-                    closed_form_exp = string_to_expression(closed_form)
+    # Interrupted or failed runs still flush the rows buffered by the writer
+    try:
+        for n, (sequence_id, raw_data, content, guess) in enumerate(yield_guessed_sequences(cursor, fetch_sequences(sequence_ids),
+                                                                                            pool, use_bm=reprocess)):
+            is_hard = False
+            is_not_easy = False
+
+            t0 = time.time()
+            if not quiet:
+                sys.stderr.write("Processing: %s...           \r" % sequence_id)
+                sys.stderr.flush()
+            if content is not None:
+                save_cached_sequence(sequence_id, content)
+
+            if raw_data is not None:
+                fail_count = 0
+                proc = n + 1
+
+                name, sdata, keyword, r_formula, r_xref = extract_fields(raw_data)
+                if keyword == 'allocated':
+                    if not quiet:
+                        print(sequence_id, keyword, "...")
+                    remove_cached_sequence(sequence_id)
+                    if (content := get_raw_sequence(sequence_id)) is None or (raw_data := parse_sequence(content)) is None:
+                        continue
+                    name, sdata, keyword, r_formula, r_xref = extract_fields(raw_data)
+                    if keyword == 'allocated':
+                        continue
+                    else:
+                        save_cached_sequence(sequence_id, content)
+
+                is_hard = keyword.find("hard") > -1
+                is_not_easy = keyword.find("easy") == -1
+
+                xref = None
+                if r_xref is not None:
+                    # Stored as JSON, the OEIS field is a list of lines scanned as one string
+                    xref = json_dumps(OEIS_XREF_RE.findall("\n".join(r_xref) if isinstance(r_xref, list) else r_xref)).decode()
+                l_formula, formula = [], ''
+                if r_formula is not None:
+                    l_formula = r_formula
+                    formula = json_dumps(l_formula).decode()
+                if (rname := regex_match_one(OEIS_NAME_PATTERNS, name)) is not None:
+                    l_formula.append(rname)
+
+                closed_form = ""
+                simplified_closed_form = ""
+                algo = None
+                field = None
+                is_new = False
+                v_regex_match = False
+                v_check_cf = None
+
+                formula_strs = formula_match_strings(OEIS_FORMULA_PATTERNS, l_formula)
+                if l_formula:
+                    formula_exps = formula_expressions(formula_strs)
+                else:
+                    formula_exps = []
 
-                    if closed_form_exp is not None and formula_exps is not None:
-                        is_new &= not (v_regex_match := formula_match_exp(formula_exps, closed_form_exp))
+                guess_key = guess_cache_key(sdata, use_bm=reprocess)
+                if guess is not None and guess[0] == sdata:
+                    _, hit, cf_algo_field = guess
+                else:
+                    hit, cf_algo_field = cached_guess(cursor, guess_key)
+                    if not hit:
+                        cf_algo_field = check_sequence(sdata, use_bm=reprocess)
+                if not hit:
+                    cf, algo, field = cf_algo_field if cf_algo_field is not None else (None, None, None)
+                    write_queue.put((guess_sql, (guess_key, None if cf is None else str(cf), algo, field)))
+
+                if cf_algo_field is not None:
+                    cf, algo, field = cf_algo_field
+                    data = parse_terms(sdata)
+                    found_count += 1
+                    closed_form = str(cf)
+
+                    if len(closed_form) > 1 and not (cf.is_integer() and cf.is_constant()):
+                        simplified_closed_form = simplify_expression(cf)
+
+                        # Name and formulas are normalized once and scanned as a single string
+                        haystack = normalize_formula(name + "\0" + formula)
+                        normalized_closed_form = normalize_formula(closed_form)
+                        is_new = normalized_closed_form not in haystack
+                        if simplified_closed_form is not None:
+                            normalized_simplified = normalize_formula(simplified_closed_form)
+                            is_new |= (normalized_closed_form not in normalized_simplified and normalized_simplified not in haystack)
+                        closed_form_exp = string_to_expression(closed_form)
+
+                        if any(normalize_formula(f) == normalized_closed_form for f in formula_strs):
+                            v_regex_match = True
+                            is_new = False
+                        elif closed_form_exp is not None and formula_exps is not None:
+                            is_new &= not (v_regex_match := formula_match_exp(formula_exps, closed_form_exp))
                                     
-                    if check_cf:
-                        v_check_cf = int(expression_verify_sequence(string_to_expression(closed_form), data))
-
-                    if simplified_closed_form != closed_form: simplified_closed_form = None 
-
-                    td = time.time() - t0
-                    tc += td
-                    m = max(m,td)
-
-                    #if is_new and is_hard:
-                    if is_new:
-                        if is_hard:
-                            hard_count += 1
-                        if is_not_easy:
-                            not_easy_count += 1
-
-                        new_count += 1
-                        if not quiet:
-                            print(80 * "=")
-                            print("ID:", sequence_id)
-                            print("NAME:", name)
-                            print(80 * "-")
-                            print("CLOSED_FORM:", closed_form, "len:", len(closed_form))
-                            if simplified_closed_form is not None and len(simplified_closed_form) > 0:
-                                if simplified_closed_form != closed_form:
-                                     print("SIMP_CLOSED_FORM:", simplified_closed_form, "len:", len(simplified_closed_form))
-                            else:
-                                print(sequence_id, "Maxima could not simplify closed form...")
-                            print("len(data):",len(data))
-                            print("keywords:", keyword)
-                            print("xref:",xref)
-                            print("algo:", algo)
-                            print("field:", field)
-                            print(80 * "-")
-
-                            if found_count > 0 and new_count > 0:
-                                print("PROC: %d, FOUND: %d, NEW: %d, RATIO (P/F): %.3f, RATIO (F/N): %.3f, RATIO(P/N): %.3f, HARD: %d, NOT EASY: %d, td: %.3f, avg: %.3f, max: %.3f"
-                                    % (proc, found_count, new_count, proc / found_count, found_count / new_count,
-                                         proc / new_count, hard_count, not_easy_count, td, tc/proc, m))
-                            #print(formula_match_regex.cache_info())
-                            print(guess_sequence.cache_info())
-                else: 
-                  closed_form = None
-                  simplified_closed_form = None
-
-            formula_exps_str = None
-            if formula_exps is not None:
-                formula_exps_str = json.dumps([str(f) for f in formula_exps]) 
-
-            if simplified_closed_form == closed_form: simplified_closed_form = None
+                        if check_cf:
+                            v_check_cf = int(expression_verify_sequence(closed_form_exp, data))
+
+                        if simplified_closed_form != closed_form: simplified_closed_form = None 
+
+                        td = time.time() - t0
+                        tc += td
+                        m = max(m,td)
+
+                        #if is_new and is_hard:
+                        if is_new:
+                            if is_hard:
+                                hard_count += 1
+                            if is_not_easy:
+                                not_easy_count += 1
+
+                            new_count += 1
+                            if not quiet:
+                                print(80 * "=")
+                                print("ID:", sequence_id)
+                                print("NAME:", name)
+                                print(80 * "-")
+                                print("CLOSED_FORM:", closed_form, "len:", len(closed_form))
+                                if simplified_closed_form is not None and len(simplified_closed_form) > 0:
+                                    if simplified_closed_form != closed_form:
+                                         print("SIMP_CLOSED_FORM:", simplified_closed_form, "len:", len(simplified_closed_form))
+                                else:
+                                    print(sequence_id, "Maxima could not simplify closed form...")
+                                print("len(data):",len(data))
+                                print("keywords:", keyword)
+                                print("xref:",xref)
+                                print("algo:", algo)
+                                print("field:", field)
+                                print(80 * "-")
+
+                                if found_count > 0 and new_count > 0:
+                                    print("PROC: %d, FOUND: %d, NEW: %d, RATIO (P/F): %.3f, RATIO (F/N): %.3f, RATIO(P/N): %.3f, HARD: %d, NOT EASY: %d, td: %.3f, avg: %.3f, max: %.3f"
+                                        % (proc, found_count, new_count, proc / found_count, found_count / new_count,
+                                             proc / new_count, hard_count, not_easy_count, td, tc/proc, m))
+                                #print(string_to_expression.cache_info())
+                                print(guess_sequence.cache_info())
+                    else: 
+                      closed_form = None
+                      simplified_closed_form = None
+
+                formula_exps_str = None
+                if formula_exps is not None:
+                    formula_exps_str = json_dumps([str(f) for f in formula_exps]).decode() 
+
+                if simplified_closed_form == closed_form: simplified_closed_form = None
             
-            sql = """UPDATE sequence SET name=?, data=?, formula=?, closed_form=?, simplified_closed_form=?, new=?, regex_match=?, parsed_formulas=?, keyword=?, xref=?, algo=?, field=?, check_cf=?, hard=?, not_easy=?  WHERE id=?"""
-            cursor.execute(sql, (name, sdata, formula, closed_form, simplified_closed_form, int(is_new),
-                int(v_regex_match), formula_exps_str, keyword, xref, algo, field, v_check_cf, is_hard, is_not_easy, sequence_id))
+                write_queue.put((sql, (name, sdata, formula, closed_form, simplified_closed_form, int(is_new),
+                    int(v_regex_match), formula_exps_str, keyword, xref, algo, field, v_check_cf, is_hard, is_not_easy, sequence_number(sequence_id), sequence_id)))
      
-        else:
-            fail_count += 1
-            if fail_count == 10:
-                sys.stderr.write(f"Failed last: {fail_count} sequences...\n")
-                sys.stderr.flush()
-                sys.exit(-1)
-
-        if n % 10 == 0:
-            conn.commit()
-
+            else:
+                fail_count += 1
+                if fail_count == 10:
+                    sys.stderr.write(f"Failed last: {fail_count} sequences...\n")
+                    sys.stderr.flush()
+                    sys.exit(-1)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        stop_database_writer(write_queue, writer)
     cursor.execute("PRAGMA optimize;")
     conn.commit()
 
 
-def yield_unchecked_closed_form(cursor):
+def yield_unchecked_closed_form(cursor, page_size = ID_PAGE_SIZE):
     """
     yields rows from table sequence.
+    Paged by id like yield_unprocessed_ids, the caller sets check_cf on the rows it gets.
     """
-    cursor.execute("select id, data , closed_form, new from sequence where closed_form is not NULL and check_cf is NULL order by id;")
-    yield from cursor
+    last_id = ''
+    while (rows := cursor.execute(f"SELECT id, data, closed_form, new FROM sequence WHERE {UNCHECKED_CONDITION} "
+                                  "AND id > ? ORDER BY id LIMIT ?;", (last_id, page_size)).fetchall()):
+        yield from rows
+        last_id = rows[-1][0]
 
 
 def verify_sequences(ignore_blacklist=False):
-    conn = sqlite3.connect(OEIS_DB_PATH)
+    conn = connect_database()
     cursor1 = conn.cursor()
-    cursor2 = conn.cursor()
 
-    commit_size = 1000
+    sql = "update sequence set check_cf=? where rowid=? and id=?;"
+    write_queue, writer = start_database_writer()
     fail_count = 0
     check_count = 0
     proc = 0 
-    e_BLACKLIST = [] if ignore_blacklist else BLACKLIST3
+    e_BLACKLIST = set() if ignore_blacklist else set(BLACKLIST3)
 
-    for x, row in enumerate(yield_unchecked_closed_form(cursor1)):
-        sequence_id = row[0]
-        if sequence_id in e_BLACKLIST: continue
-        data=[int(x) for x in row[1].split(",")]
-        closed_form = row[2]
-        new = row[3]
-        if len(closed_form) > 1:
-            proc += 1 
-            exp = string_to_expression(closed_form)
-            ok = expression_verify_sequence(exp, data)
-            cursor2.execute("update sequence set check_cf=? where id=?;", (int(ok),sequence_id))
-            print(f"id: {sequence_id}, cf: {closed_form}, new: {new}, ok: {ok}         ")
-            if ok:
-                check_count += 1
-            else:
-                fail_count += 1
-        if x > 0 and x & commit_size == 0:
-            conn.commit()
-        if check_count > 0 and fail_count > 0:
-            sys.stderr.write("sequence id: %s, PROC: %d, check: %d, fail: %d, RATIO(P/C): %.3f RATIO(P/F): %.3f \r" %(sequence_id, proc, check_count, fail_count, proc / check_count, proc / fail_count) )
-            sys.stderr.flush()
-    
-    cursor2.execute("PRAGMA optimize;")
+    try:
+        for x, row in enumerate(yield_unchecked_closed_form(cursor1)):
+            sequence_id = row[0]
+            if sequence_id in e_BLACKLIST: continue
+            data = parse_terms(row[1])
+            closed_form = row[2]
+            new = row[3]
+            if len(closed_form) > 1:
+                proc += 1 
+                exp = string_to_expression(closed_form)
+                ok = expression_verify_sequence(exp, data)
+                write_queue.put((sql, (int(ok), sequence_number(sequence_id), sequence_id)))
+                print(f"id: {sequence_id}, cf: {closed_form}, new: {new}, ok: {ok}         ")
+                if ok:
+                    check_count += 1
+                else:
+                    fail_count += 1
+            if check_count > 0 and fail_count > 0:
+                sys.stderr.write("sequence id: %s, PROC: %d, check: %d, fail: %d, RATIO(P/C): %.3f RATIO(P/F): %.3f \r" %(sequence_id, proc, check_count, fail_count, proc / check_count, proc / fail_count) )
+                sys.stderr.flush()
+    finally:
+        stop_database_writer(write_queue, writer)
+    cursor1.execute("PRAGMA optimize;")
     conn.commit()
 
 
@@ -616,16 +1461,16 @@ def yield_not_simplified_closed_form(cursor):
 def simplify_existing_closed_form(ignore_blacklist=False):
     """
     """
-    conn = sqlite3.connect(OEIS_DB_PATH)
+    conn = connect_database()
     cursor1 = conn.cursor()
     cursor2 = conn.cursor()
-
+    e_BLACKLIST = set() if ignore_blacklist else set(BLACKLIST)
 
     for x, row in enumerate(yield_not_simplified_closed_form(cursor1)):
         sequence_id = row[0]
         closed_form = row[1]
 
-        if sequence_id in BLACKLIST: #or sequence_id not in ['A000027']:
+        if sequence_id in e_BLACKLIST: #or sequence_id not in ['A000027']:
             continue
 
         sys.stderr.write(f"Processing {sequence_id}...\r")
@@ -644,12 +1489,32 @@ def simplify_existing_closed_form(ignore_blacklist=False):
     conn.commit()
 
 
-def process_xrefs(ignore_blacklist=False):
+def canonical_formulas_worker(row):
+    """
+    Parses the formulas of a sequence and keys them by their expanded form, runs in a process of the xref pool.
+    Formulas are deduplicated by printed form, symbolic membership tests in a list cost a Maxima call each.
+
+    Args:
+        row (tuple): (sequence_id, parsed_formulas JSON).
+
+    Returns:
+        tuple: (sequence_id, list of (expanded form, formula)) with one entry per distinct expression.
+    """
+    sequence_id, parsed_formulas = row
+    fexps = {}
+    for formula in dict.fromkeys(json_loads(parsed_formulas)):
+        if len(formula) > 1 and (fexp := string_to_expression(formula)) is not None:
+            fexps.setdefault(str(fexp), fexp)
+    return sequence_id, [(str(fexp.expand()), formula) for formula, fexp in fexps.items()]
+
+
+def process_xrefs(ignore_blacklist=False, jobs=GUESS_WORKERS):
     """
     Tries to find new xrefs comparing equivalences in parsed formula expressions.
+    Formulas are parsed and expanded by a pool of jobs processes.
     Experimental feature: might not work or be removed in the future.
     """
-    conn = sqlite3.connect(OEIS_DB_PATH)
+    conn = connect_database()
     cursor = conn.cursor()
 
     fail_count = 0
@@ -658,63 +1523,72 @@ def process_xrefs(ignore_blacklist=False):
     hard_count = 0
     not_easy_count = 0
     formula_count = 0
-    e_BLACKLIST = [] if ignore_blacklist else BLACKLIST2
+    e_BLACKLIST = set() if ignore_blacklist else set(BLACKLIST2)
 
     D={}
-    try:
-        A = decompress_pickle(XREF_PKL_FILE)
-    except:
-        A = {}
 
     sys.stderr.write("Loading formulas from database...\n")
     sys.stderr.flush()
 
-    for x, row in tqdm(enumerate(cursor.execute("select id, parsed_formulas from sequence where parsed_formulas is not NULL order by id;"))):
-        if row[1] is not None:
-            parsed_formulas = json.loads(row[1])
-            sequence_id = row[0]
-            D[sequence_id] = []
-            for formula in parsed_formulas:
-                if len(formula) > 1:
-                    #sys.stderr.write(f"{x+1}, {sequence_id}, {formula}, {len(formula)}\r")
-                    #sys.stderr.flush()
-                    fexp = string_to_expression(formula)           
-                    if fexp not in D[sequence_id]:
-                        D[sequence_id].append(fexp)
-                        formula_count += 1
+    # Keyed formulas of previous runs, only sequences whose parsed formulas changed are parsed again.
+    # Pickles of older versions held the visited pairs instead and are discarded.
+    try:
+        xref_cache = decompress_pickle(XREF_PKL_FILE)
+    except Exception:
+        xref_cache = None
+    if not isinstance(xref_cache, dict) or 'formulas' not in xref_cache:
+        xref_cache = {'formulas': {}}
+    cached_formulas = xref_cache['formulas']
+
+    # Fetched up front, the pool feeds its workers from another thread that can not use the cursor
+    rows = []
+    for sequence_id, parsed_formulas in cursor.execute(f"SELECT id, parsed_formulas FROM sequence WHERE {PARSED_CONDITION} ORDER BY id;"):
+        if (cached := cached_formulas.get(sequence_id)) is not None and cached[0] == parsed_formulas:
+            D[sequence_id] = cached[1]
+        else:
+            rows.append((sequence_id, parsed_formulas))
+    sys.stderr.write(f"Reusing {len(D)} sequences from {XREF_PKL_FILE}, parsing {len(rows)}...\n")
+    sys.stderr.flush()
+    if rows:
+        parsed = dict(rows)
+        with multiprocessing.Pool(processes=jobs) as pool:
+            for sequence_id, keyed_formulas in tqdm(pool.imap(canonical_formulas_worker, rows, chunksize=64), total=len(rows)):
+                D[sequence_id] = keyed_formulas
+                cached_formulas[sequence_id] = (parsed[sequence_id], keyed_formulas)
+        compress_pickle(XREF_PKL_FILE, xref_cache)
+    formula_count = sum(len(keyed_formulas) for keyed_formulas in D.values())
     sys.stderr.write("done\n")
     sys.stderr.flush()
 
-    sk = sorted(D.keys())
-    lsk = len(sk)
-    print("Total sequences to process: %d, formulas: %d, total work to do (n(n-1)/2): %d" % (lsk, formula_count, lsk*(lsk-1) // 2))
-    for i in tqdm(range(0,lsk)):
-        count = 0
-        id_a = sk[i]
-        l_fexp_a = D[id_a]
-        if id_a not in A: A[id_a] = []
-        if id_a not in BLACKLIST:
-            for j in range(i + 1, lsk):
-                id_b = sk[j]
-                sys.stderr.write("%s, %d of %d           \r" % (id_b,j-i,lsk-i))
-                sys.stderr.flush()
-                if id_b not in A[id_a] and id_b not in BLACKLIST:
-                    l_fexp_b = D[id_b]
-                    for fexp_a in l_fexp_a:
-                        for fexp_b in l_fexp_b:
-                            if fexp_a == fexp_b:
-                                print("="*80)
-                                print("new xref:")
-                                print("seq a:", id_a, fexp_a, "seq b:", id_b, fexp_b)
-                                print("-"*80)
-                                sql = "insert into matches values (?,?,?,?);"
-                                cursor.execute(sql,(id_a,id_b, str(fexp_a), str(fexp_b)))
-                                count += 1
-                    A[id_a].append(id_b)  
-        if count > 0:    
-            compress_pickle(XREF_PKL_FILE, A)
-            conn.commit()
-        print(id_a, "processed xrefs:", len(A[id_a]))
+    # Equal expressions share their expanded form, so only pairs within a bucket are candidates
+    # Parallel lists with one entry per expression, buckets only hold their indices
+    ids, keys, fexps = [], [], []
+    for sequence_id in sorted(D):
+        if sequence_id not in e_BLACKLIST:
+            for key, fexp in D[sequence_id]:
+                ids.append(sequence_id)
+                keys.append(key)
+                fexps.append(fexp)
+    buckets = defaultdict(list)
+    for i, key in enumerate(keys):
+        buckets[key].append(i)
+    print("Total sequences to process: %d, formulas: %d, buckets: %d" % (len(D), formula_count, len(buckets)))
+
+    known = set(cursor.execute("select id_a, id_b, formula_a, formula_b from matches;"))
+    sql = "insert into matches(id_a, id_b, formula_a, formula_b) values (?,?,?,?);"
+    count = 0
+    for group in tqdm(buckets.values()):
+        for a, b in combinations(group, 2):
+            id_a, id_b, fexp_a, fexp_b = match = (ids[a], ids[b], fexps[a], fexps[b])
+            if id_a != id_b and match not in known:
+                print("="*80)
+                print("new xref:")
+                print("seq a:", id_a, fexp_a, "seq b:", id_b, fexp_b)
+                print("-"*80)
+                cursor.execute(sql, match)
+                known.add(match)
+                count += 1
+    print("new xrefs:", count)
 
     cursor.execute("PRAGMA optimize;")
     conn.commit()
@@ -732,6 +1606,9 @@ def main():
     parser.add_argument('-q', '--quiet', action='store_true', help='Quiet mode (only prints new found closed forms).')
     parser.add_argument('-r', '--reprocess', action='store_true', help='Reprocess already processed sequences.')
     parser.add_argument('-s','--simplify-closed_form', action='store_true', help='Simplify already found closed forms.')
+    parser.add_argument('-m', '--migrate-cache', action='store_true', help='Move cached sequences into the sharded layout.')
+    parser.add_argument('-j', '--jobs', type=int, default=GUESS_WORKERS, help='Number of processes guessing closed forms.')
+    parser.add_argument('-t', '--train-dictionary', action='store_true', help='Train the zstd dictionary of the sequence cache.')
 
     args = parser.parse_args()
 
@@ -739,21 +1616,25 @@ def main():
 
     if args.download:
         download_only_remaining(args.download[0], args.download[1])
+    elif args.migrate_cache:
+        migrate_cached_sequences()
+    elif args.train_dictionary:
+        train_zstd_dictionary()
     elif args.simplify_closed_form:
         simplify_existing_closed_form(ignore_blacklist = args.ignore_blacklist)        
     elif args.process_xrefs:
-        process_xrefs()
+        process_xrefs(jobs = args.jobs)
     elif args.add_to_blacklist:
         add_to_blacklist(args.add_to_blacklist)
     elif args.verify_sequences:
         verify_sequences(ignore_blacklist = args.ignore_blacklist)
     elif args.ignore_blacklist:
         sys.stderr.write('Begin processing sequences (ignoring blacklist)...\n')
-        process_sequences(True, quiet=args.quiet, reprocess = args.reprocess)
+        process_sequences(True, quiet=args.quiet, reprocess = args.reprocess, jobs = args.jobs)
         sys.stderr.write('End.\n')
     else:
         sys.stderr.write('Begin processing sequences...\n')
-        process_sequences(quiet=args.quiet, reprocess = args.reprocess)
+        process_sequences(quiet=args.quiet, reprocess = args.reprocess, jobs = args.jobs)
         sys.stderr.write('End.\n')
     sys.stderr.flush()
 